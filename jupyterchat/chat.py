@@ -1,11 +1,20 @@
 import asyncio
+import collections
+import functools
+import itertools
+import json
 import uuid
 from typing import List
 
+import anywidget
 import ipywidgets as widgets
-import markdown2
+from markdown_it import MarkdownIt
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
 
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, AIMessageChunk, ToolMessage
 from langchain_core.runnables import Runnable
 
 _LABEL_COLOURS = {
@@ -15,132 +24,306 @@ _LABEL_COLOURS = {
     "tool": "orange"
 }
 
+_DESCRIPTIONS = {
+    sender: f'<span style="color: {colour}">{sender}:</span>'
+    for sender, colour in _LABEL_COLOURS.items()
+}
+
+_MESSAGE_CLASSES = {
+    "system": SystemMessage,
+    "user": HumanMessage,
+    "agent": AIMessage,
+    "tool": ToolMessage
+}
+
 _CODE_STYLE_INFO = {
-    '': {'bg': '#f8f8f8'},
-    'bp': {'c': '#008000'},
-    'c': {'c': '#408080', 's': 'italic'},
-    'c1': {'c': '#408080', 's': 'italic'},
-    'ch': {'c': '#408080', 's': 'italic'},
-    'cm': {'c': '#408080', 's': 'italic'},
-    'cp': {'c': '#BC7A00'},
-    'cpf': {'c': '#408080', 's': 'italic'},
-    'cs': {'c': '#408080', 's': 'italic'},
-    'dl': {'c': '#BA2121'},
-    'err': {'br': '1px solid #FF0000'},
-    'fm': {'c': '#0000FF'},
-    'gd': {'c': '#A00000'},
-    'ge': {'s': 'italic'},
-    'gh': {'c': '#000080', 'w': 'bold'},
-    'gi': {'c': '#00A000'},
-    'go': {'c': '#888888'},
-    'gp': {'c': '#000080', 'w': 'bold'},
-    'gr': {'c': '#FF0000'},
-    'gs': {'w': 'bold'},
-    'gt': {'c': '#0044DD'},
-    'gu': {'c': '#800080', 'w': 'bold'},
-    'hll': {'bg': '#ffffcc'},
-    'il': {'c': '#666666'},
-    'k': {'c': '#008000', 'w': 'bold'},
-    'kc': {'c': '#008000', 'w': 'bold'},
-    'kd': {'c': '#008000', 'w': 'bold'},
-    'kn': {'c': '#008000', 'w': 'bold'},
-    'kp': {'c': '#008000'},
-    'kr': {'c': '#008000', 'w': 'bold'},
-    'kt': {'c': '#B00040'},
-    'm': {'c': '#666666'},
-    'mb': {'c': '#666666'},
-    'mf': {'c': '#666666'},
-    'mh': {'c': '#666666'},
-    'mi': {'c': '#666666'},
-    'mo': {'c': '#666666'},
-    'na': {'c': '#7D9029'},
-    'nb': {'c': '#008000'},
-    'nc': {'c': '#0000FF', 'w': 'bold'},
-    'nd': {'c': '#AA22FF'},
-    'ne': {'c': '#D2413A', 'w': 'bold'},
-    'nf': {'c': '#0000FF'},
-    'ni': {'c': '#999999', 'w': 'bold'},
-    'nl': {'c': '#A0A000'},
-    'nn': {'c': '#0000FF', 'w': 'bold'},
-    'no': {'c': '#880000'},
-    'nt': {'c': '#008000', 'w': 'bold'},
-    'nv': {'c': '#19177C'},
-    'o': {'c': '#666666'},
-    'ow': {'c': '#AA22FF', 'w': 'bold'},
-    's': {'c': '#BA2121'},
-    's1': {'c': '#BA2121'},
-    's2': {'c': '#BA2121'},
-    'sa': {'c': '#BA2121'},
-    'sb': {'c': '#BA2121'},
-    'sc': {'c': '#BA2121'},
-    'sd': {'c': '#BA2121', 's': 'italic'},
-    'se': {'c': '#BB6622', 'w': 'bold'},
-    'sh': {'c': '#BA2121'},
-    'si': {'c': '#BB6688', 'w': 'bold'},
-    'sr': {'c': '#BB6688'},
-    'ss': {'c': '#19177C'},
-    'sx': {'c': '#008000'},
-    'vc': {'c': '#19177C'},
-    'vg': {'c': '#19177C'},
-    'vi': {'c': '#19177C'},
-    'vm': {'c': '#19177C'},
-    'w': {'c': '#bbbbbb'}
+    '': {'background': '#f8f8f8'},
+    'bp': {'color': '#008000'},
+    'c': {'color': '#408080', 'font-style': 'italic'},
+    'c1': {'color': '#408080', 'font-style': 'italic'},
+    'ch': {'color': '#408080', 'font-style': 'italic'},
+    'cm': {'color': '#408080', 'font-style': 'italic'},
+    'cp': {'color': '#BC7A00'},
+    'cpf': {'color': '#408080', 'font-style': 'italic'},
+    'cs': {'color': '#408080', 'font-style': 'italic'},
+    'dl': {'color': '#BA2121'},
+    'err': {'border': '1px solid #FF0000'},
+    'fm': {'color': '#0000FF'},
+    'gd': {'color': '#A00000'},
+    'ge': {'font-style': 'italic'},
+    'gh': {'color': '#000080', 'font-weight': 'bold'},
+    'gi': {'color': '#00A000'},
+    'go': {'color': '#888888'},
+    'gp': {'color': '#000080', 'font-weight': 'bold'},
+    'gr': {'color': '#FF0000'},
+    'gs': {'font-weight': 'bold'},
+    'gt': {'color': '#0044DD'},
+    'gu': {'color': '#800080', 'font-weight': 'bold'},
+    'hll': {'background': '#ffffcc'},
+    'il': {'color': '#666666'},
+    'k': {'color': '#008000', 'font-weight': 'bold'},
+    'kc': {'color': '#008000', 'font-weight': 'bold'},
+    'kd': {'color': '#008000', 'font-weight': 'bold'},
+    'kn': {'color': '#008000', 'font-weight': 'bold'},
+    'kp': {'color': '#008000'},
+    'kr': {'color': '#008000', 'font-weight': 'bold'},
+    'kt': {'color': '#B00040'},
+    'm': {'color': '#666666'},
+    'mb': {'color': '#666666'},
+    'mf': {'color': '#666666'},
+    'mh': {'color': '#666666'},
+    'mi': {'color': '#666666'},
+    'mo': {'color': '#666666'},
+    'na': {'color': '#7D9029'},
+    'nb': {'color': '#008000'},
+    'nc': {'color': '#0000FF', 'font-weight': 'bold'},
+    'nd': {'color': '#AA22FF'},
+    'ne': {'color': '#D2413A', 'font-weight': 'bold'},
+    'nf': {'color': '#0000FF'},
+    'ni': {'color': '#999999', 'font-weight': 'bold'},
+    'nl': {'color': '#A0A000'},
+    'nn': {'color': '#0000FF', 'font-weight': 'bold'},
+    'no': {'color': '#880000'},
+    'nt': {'color': '#008000', 'font-weight': 'bold'},
+    'nv': {'color': '#19177C'},
+    'o': {'color': '#666666'},
+    'ow': {'color': '#AA22FF', 'font-weight': 'bold'},
+    's': {'color': '#BA2121'},
+    's1': {'color': '#BA2121'},
+    's2': {'color': '#BA2121'},
+    'sa': {'color': '#BA2121'},
+    'sb': {'color': '#BA2121'},
+    'sc': {'color': '#BA2121'},
+    'sd': {'color': '#BA2121', 'font-style': 'italic'},
+    'se': {'color': '#BB6622', 'font-weight': 'bold'},
+    'sh': {'color': '#BA2121'},
+    'si': {'color': '#BB6688', 'font-weight': 'bold'},
+    'sr': {'color': '#BB6688'},
+    'ss': {'color': '#19177C'},
+    'sx': {'color': '#008000'},
+    'vc': {'color': '#19177C'},
+    'vg': {'color': '#19177C'},
+    'vi': {'color': '#19177C'},
+    'vm': {'color': '#19177C'},
+    'w': {'color': '#bbbbbb'}
 }
 
 
-_CODE_CSS = None
+# Minimum interval, in seconds, between widget refreshes while a reply is streaming
+_FLUSH_INTERVAL = 0.1
+
+# Number of recent status lines kept in the debug pane
+_DEBUG_LINES = 200
+
+_FENCE = "\n```"
+
+
+def _build_code_css():
+    unpacked = "\n".join(
+        ".codehilite" + (" ." + name if name else "") + " { " + "; ".join(
+            f"{prop}: {value}" for prop, value in style_info.items()
+        ) + " }"
+        for name, style_info in _CODE_STYLE_INFO.items()
+    )
+    return f"<style>\n{unpacked}\n</style>\n"
+
+
+_CODE_CSS = _build_code_css()
+
+
+_CODE_FORMATTER = HtmlFormatter(nowrap=True)
+
 
+@functools.lru_cache(maxsize=None)
+def _get_lexer(lang):
+    try:
+        return get_lexer_by_name(lang)
+    except ClassNotFound:
+        return None
 
-def _get_code_css():
-    global _CODE_CSS
-    if _CODE_CSS is None:
-        style_items = {
-            'bg': 'background',
-            'br': 'border',
-            'c': 'color',
-            's': 'font-style',
-            'w': 'font-weight'
+
+def _highlight_code(code, lang, _attrs):
+    lexer = _get_lexer(lang) if lang else None
+    if lexer is None:
+        # Let markdown-it emit a plain escaped code block
+        return ""
+    # Output starting with <pre is used verbatim, and the class picks up the _CODE_CSS rules
+    return '<pre class="codehilite"><code>' + highlight(code, lexer, _CODE_FORMATTER) + "</code></pre>"
+
+
+_MD = MarkdownIt("commonmark", {"highlight": _highlight_code}).enable("table")
+
+
+@functools.lru_cache(maxsize=256)
+def _render_markdown(text):
+    return _MD.render(text)
+
+
+_THREAD_ESM = """
+function render({ model, el }) {
+    const nodes = new Map();
+
+    function append(item) {
+        const row = document.createElement("div");
+        row.className = "jupyterchat-item";
+        const label = document.createElement("div");
+        label.className = "jupyterchat-label";
+        label.innerHTML = item.label;
+        const body = document.createElement("div");
+        body.className = "jupyterchat-body";
+        body.innerHTML = item.html;
+        row.append(label, body);
+        el.append(row);
+        nodes.set(item.id, { label, body });
+    }
+
+    function onMessage(msg) {
+        if (msg.op === "append") {
+            append(msg);
+        } else if (msg.op === "patch") {
+            const node = nodes.get(msg.id);
+            if (node === undefined) {
+                return;
+            }
+            if (msg.label !== undefined) {
+                node.label.innerHTML = msg.label;
+            }
+            if (msg.html !== undefined) {
+                node.body.innerHTML = msg.html;
+            }
+        } else if (msg.op === "reset") {
+            el.replaceChildren();
+            nodes.clear();
+            msg.items.forEach(append);
         }
-        unpacked = "\n".join(
-            ".codehilite" + (" ." + name if name else "") + " { " + "; ".join(
-                style_items[k] + ": " + v
-                for k, v in style_info.items()
-            ) + " }"
-            for name, style_info in _CODE_STYLE_INFO.items()
-        )
-        _CODE_CSS = f"<style>\n{unpacked}\n</style>\n"
-    return _CODE_CSS
+    }
+
+    el.classList.add("jupyterchat-thread");
+    model.on("msg:custom", onMessage);
+    // Patches sent before this view existed were missed, so ask for the current contents
+    model.send({ op: "sync" });
+    return () => model.off("msg:custom", onMessage);
+}
+
+export default { render };
+"""
+
+_THREAD_CSS = """
+.jupyterchat-item { display: flex; align-items: baseline; }
+.jupyterchat-label { flex: 0 0 auto; width: 80px; padding-right: 8px; text-align: right; }
+.jupyterchat-body { flex: 1 1 auto; min-width: 0; }
+"""
+
+
+class ThreadView(anywidget.AnyWidget):
+    _esm = _THREAD_ESM
+    _css = _THREAD_CSS
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._ids = itertools.count()
+        self._items = {}
+        self.on_msg(self._handle_message)
+
+    def append(self, label, html):
+        item_id = next(self._ids)
+        self._items[item_id] = {"id": item_id, "label": label, "html": html}
+        self.send({"op": "append", "id": item_id, "label": label, "html": html})
+        return item_id
+
+    def patch(self, item_id, label=None, html=None):
+        update = {}
+        if label is not None:
+            update["label"] = label
+        if html is not None:
+            update["html"] = html
+        self._items[item_id].update(update)
+        self.send({"op": "patch", "id": item_id, **update})
+
+    def _handle_message(self, widget, content, buffers):
+        _ = widget, buffers
+        if content.get("op") == "sync":
+            self.send({"op": "reset", "items": list(self._items.values())})
 
 
 class ThreadItem:
-    def __init__(self, text: str, sender: str, tool_name=None):
+    def __init__(self, view: ThreadView, text: str, sender: str, tool_name=None):
         if sender not in _LABEL_COLOURS:
             raise ValueError(f"Unknown sender: {sender}")
         self._sender = sender
-        self._text = text
+        self._set_text(text)
         self._tool_name = tool_name
-        self._widget = widgets.HTML(self.html, description=self.description)
+        self._stale = False
+        self._view = view
+        self._sent_html = self.html
+        self._id = view.append(_DESCRIPTIONS[sender], self._sent_html)
 
     @property
     def html(self):
-        text = self._text
+        text = self.text
+        key = (self._sender, self._tool_name, text)
+        if key == self._cached_key:
+            return self._cached_html
+
         if self._sender == "tool":
             name = self._tool_name if self._tool_name else "???"
-            text = f"### Tool use for: `{name}`\n```json\n{text}\n```\n"
+            html = _render_markdown(f"### Tool use for: `{name}`\n```json\n{text}\n```\n")
+        elif self._streaming:
+            html = self._render_streaming(text)
         else:
-            text += "\n```\n" if text.count("\n```") % 2 else ""
+            text += "\n```\n" if self._fence_count % 2 else ""
+            html = _render_markdown(text)
 
-        html = markdown2.markdown(text, extras=["fenced-code-blocks", "tables"])
+        self._cached_key = key
+        self._cached_html = html
 
         return html
 
     @property
-    def description(self):
-        return r"\(\color{" + _LABEL_COLOURS[self._sender] + "}{" + self._sender + r":}\)"
+    def text(self):
+        # Streamed chunks are only joined when the full text is actually needed
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0]
+
+    def _render_streaming(self, text):
+        # Blocks before the last blank line outside a code fence won't change as more text
+        # arrives, so they are rendered once and only the trailing block is re-rendered.
+        boundary = text.rfind("\n\n", self._stable_len)
+        if boundary != -1:
+            boundary += 2
+            fences = self._stable_fences + text.count(_FENCE, max(self._stable_len - 1, 0), boundary)
+            if self._stable_len == 0 and text.startswith(_FENCE[1:]):
+                # A fence at the very start of the text has no newline before it
+                fences += 1
+            if fences % 2 == 0:
+                self._stable_html += _render_markdown(text[self._stable_len:boundary])
+                self._stable_len = boundary
+                self._stable_fences = fences
+
+        tail = text[self._stable_len:]
+        if (self._fence_count - self._stable_fences) % 2:
+            tail += "\n```\n"
+        return self._stable_html + _MD.render(tail)
+
+    def _set_text(self, text):
+        self._chunks = [text]
+        # Counting from a leading newline also catches a fence at the very start of the text
+        self._fence_count = ("\n" + text).count(_FENCE)
+        # Enough trailing text to spot a fence that straddles two appended chunks
+        self._fence_tail = ("\n" + text)[1 - len(_FENCE):]
+        # The cached HTML may come from the incremental renderer, so it can't be reused
+        self._cached_key = None
+        self._cached_html = None
+        self._streaming = False
+        self._stable_len = 0
+        self._stable_fences = 0
+        self._stable_html = ""
+        self._message = None
 
     @property
-    def widget(self):
-        return self._widget
+    def description(self):
+        return _DESCRIPTIONS[self._sender]
 
     @property
     def sender(self):
@@ -150,51 +333,83 @@ class ThreadItem:
     def sender(self, sender: str):
         if sender not in _LABEL_COLOURS:
             raise ValueError(f"Unknown sender: {sender}")
+        if sender == self._sender:
+            return
         self._sender = sender
-        self._widget.description = self.description
+        self._message = None
+        self._view.patch(self._id, label=self.description)
 
     @property
     def message(self):
-        match self._sender:
-            case "system":
-                return SystemMessage(content=self._text)
-            case "user":
-                return HumanMessage(content=self._text)
-            case "agent":
-                return AIMessage(content=self._text)
-            case "tool":
-                return ToolMessage(content=self._text)
+        if self._message is None:
+            self._message = _MESSAGE_CLASSES[self._sender](content=self.text)
+        return self._message
+
+    def _send_html(self):
+        html = self.html
+        if html != self._sent_html:
+            self._sent_html = html
+            self._view.patch(self._id, html=html)
 
     def update(self, text, tool_name=None):
-        self._text = text
+        self._set_text(text)
         if tool_name:
             self._tool_name = tool_name
-        self._widget.value = self.html
-
-    def append_text(self, text, tool_name=None):
-        self._text += text
+        self._stale = False
+        self._send_html()
+
+    def append_text(self, text, tool_name=None, flush=True):
+        self._chunks.append(text)
+        tail = self._fence_tail + text
+        self._fence_count += tail.count(_FENCE)
+        self._fence_tail = tail[1 - len(_FENCE):]
+        self._streaming = True
+        self._message = None
         if tool_name:
             self._tool_name = tool_name
-        self._widget.value = self.html
+        if flush:
+            self._stale = False
+            self._send_html()
+        else:
+            self._stale = True
+
+    def flush(self):
+        if self._stale:
+            self._stale = False
+            self._send_html()
+
+    def finish(self):
+        # Swap the incremental rendering used while streaming for a full render of the final text
+        if self._streaming:
+            self._set_text(self.text)
+            self._stale = False
+            self._send_html()
 
 
 class ChatDisplay(widgets.VBox):
     def __init__(self, app: Runnable, debug: bool = False):
         self.app = app
         self._thread_id = uuid.uuid4()
+        self._config = {"configurable": {"thread_id": self._thread_id}}
         self.thread_items: List[ThreadItem] = []
         # The status label also serves to ensure we have the code CSS style, so it's HTML
         self.status_label = widgets.HTML("")
         self._status = ""
-        self.thread = widgets.VBox(children=[])
+        self.thread = ThreadView()
         if debug:
             self.debug = widgets.Textarea(description="Debug")
+            self._debug_buf = collections.deque(maxlen=_DEBUG_LINES)
         else:
             self.debug = None
+            self._debug_buf = None
         self.input = widgets.Textarea(placeholder="Enter your message:")
         self.button = widgets.Button(description="Send")
         self.button.on_click(self.send_message)
         self._message_task = None
+        self._loop = asyncio.get_event_loop()
+        self._stale_items = set()
+        self._flush_handle = None
+        self._last_flush = 0.0
 
         self.status = "Idle"
 
@@ -211,78 +426,139 @@ class ChatDisplay(widgets.VBox):
     @status.setter
     def status(self, value):
         self._status = value
-        self.status_label.value = _get_code_css() + "Status: " + value
+        self.status_label.value = _CODE_CSS + "Status: " + value
         if self.debug:
-            self.debug.value += value + "\n"
+            self._debug_buf.append(value)
+            self.debug.value = "\n".join(self._debug_buf) + "\n"
+
+    def _set_status(self, value, verbose=True):
+        # Verbose progress updates cost a widget round trip each, so only show them when debugging
+        if verbose and self.debug is None:
+            return
+        self.status = value
 
     def send_message(self, button):
         _ = button
-        self.status = "User clicked"
+        self._set_status("User clicked")
         message = self.input.value
-        self.status = f"Got message: {message}"
+        self._set_status(f"Got message: {message}")
         self.input.value = ""
         item = self._push_new_message(text=message)
 
-        self.status = "Message appended"
-
-        run_loop = asyncio.get_event_loop()
+        self._set_status("Message appended")
 
-        self.status = f"Have run loop: {run_loop}"
+        self._message_task = self._loop.create_task(self.process_message(item))
 
-        self._message_task = run_loop.create_task(self.process_message(item))
-
-        self.status = f"Created task: {self._message_task}"
+        self._set_status(f"Created task: {self._message_task}")
 
     def _push_new_message(self, text="", sender="user", tool_name=None):
-        item = ThreadItem(text=text, sender=sender, tool_name=tool_name)
+        item = ThreadItem(self.thread, text=text, sender=sender, tool_name=tool_name)
         self.thread_items.append(item)
-        self.thread.children = [item.widget for item in self.thread_items]
         return item
 
+    @staticmethod
+    def _finish_message(item):
+        if item is not None:
+            item.finish()
+
+    def _append_streamed(self, item: ThreadItem, text, tool_name=None):
+        item.append_text(text, tool_name=tool_name, flush=False)
+        self._queue_flush(item)
+
+    def _queue_flush(self, item: ThreadItem):
+        self._stale_items.add(item)
+        if self._flush_handle is not None:
+            return
+        delay = self._last_flush + _FLUSH_INTERVAL - self._loop.time()
+        if delay <= 0:
+            self._flush()
+        else:
+            self._flush_handle = self._loop.call_later(delay, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for item in self._stale_items:
+            item.flush()
+        self._stale_items.clear()
+        self._last_flush = self._loop.time()
+
     async def process_message(self, message: ThreadItem):
-        self.status = "Sending message"
+        self._set_status("Sending message", verbose=False)
 
-        stream = self.app.astream_events(
+        # Only the chat model output is shown, so stream message chunks rather than every run event.
+        # The app checkpoints the conversation against the thread ID, so each turn only sends the new message.
+        stream = self.app.astream(
             {"messages": [message.message]},
-            config={"configurable": {"thread_id": self._thread_id}},
-            version="v2"
+            config=self._config,
+            stream_mode="messages"
         )
 
-        self.status = f"Stream created: {stream}"
+        self._set_status(f"Stream created: {stream}")
 
         current_message = None
-        self.status = f"Stream handler entered: {stream}"
-
-        async for event in stream:
-            self.status = event["event"]
-            if event['event'] == "on_chat_model_start":
+        current_id = None
+        self._set_status(f"Stream handler entered: {stream}")
+
+        async for chunk, _ in stream:
+            self._set_status(type(chunk).__name__)
+            if isinstance(chunk, AIMessageChunk):
+                complete = False
+            elif isinstance(chunk, AIMessage):
+                # Models that don't stream deliver their whole reply as a single message
+                complete = True
+            else:
+                continue
+
+            if complete or chunk.id != current_id:
+                # A new model response has started
+                current_id = chunk.id
+                self._finish_message(current_message)
                 current_message = None
-            elif event['event'] == "on_chat_model_stream":
-                content = event['data']['chunk'].content
-                for c in content:
-                    if 'type' in c and c['type'] == "text":
-                        if current_message is None or current_message.sender != "agent":
-                            current_message = self._push_new_message(sender="agent")
-
-                        current_message.append_text(c['text'])
-                    elif 'type' in c and c['type'] == "tool_use":
-                        if current_message is None or current_message.sender != "tool":
-                            current_message = self._push_new_message(sender="tool", tool_name=c.get('name'))
-
-                        if 'input' in c:
-                            current_message.append_text(c['input'], tool_name=c.get('name'))
-            elif event['event'] == "on_chat_model_end":
-                # display(JSON(event))
-                content = event['data']['output'].content
-                c = content[-1]
-                if 'type' in c and c['type'] == "text":
-                    chat_output = c['text']
+
+            # Text pieces within one chunk are gathered so the message is only appended to once
+            text_buf = []
+            content = chunk.content
+            if isinstance(content, str):
+                # Most chat models, and Anthropic without bound tools, stream plain strings
+                content = [{'type': "text", 'text': content}]
+            for c in content:
+                if not isinstance(c, dict):
+                    continue
+                kind = c.get('type')
+                if kind == "text":
                     if current_message is None or current_message.sender != "agent":
+                        self._finish_message(current_message)
                         current_message = self._push_new_message(sender="agent")
-                    current_message.update(chat_output)
-                elif 'type' in c and c['type'] == "tool_use":
-                    if 'input' in c:
-                        tool_output = c['input']
-                        if current_message is None or current_message.sender != "tool":
-                            current_message = self._push_new_message(sender="tool", tool_name=c.get('name'))
-                        current_message.update(tool_output, tool_name=c.get('name'))
+
+                    text_buf.append(c['text'])
+                elif kind == "tool_use":
+                    if text_buf:
+                        self._append_streamed(current_message, "".join(text_buf))
+                        text_buf = []
+
+                    if current_message is None or current_message.sender != "tool":
+                        self._finish_message(current_message)
+                        current_message = self._push_new_message(sender="tool", tool_name=c.get('name'))
+
+                    tool_input = c.get('input')
+                    if isinstance(tool_input, dict) and tool_input:
+                        # The complete input can arrive up front, with no input_json_delta blocks after it
+                        tool_input = json.dumps(tool_input)
+                    if isinstance(tool_input, str):
+                        self._append_streamed(current_message, tool_input, tool_name=c.get('name'))
+                elif kind == "input_json_delta":
+                    if current_message is not None and current_message.sender == "tool":
+                        self._append_streamed(current_message, c['partial_json'])
+            if text_buf:
+                self._append_streamed(current_message, "".join(text_buf))
+
+            if complete:
+                self._finish_message(current_message)
+                current_message = None
+                current_id = None
+
+        self._flush()
+        self._finish_message(current_message)
+        self._set_status("Idle", verbose=False)